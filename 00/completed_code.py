@@ -1,24 +1,71 @@
 import anthropic
+import functools
+import httpx
 import json
+import mmap
 import os
 import inspect
+import re
+import time
 
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 from dotenv import load_dotenv
 from typing import Any, Dict, List, Tuple
 
+# orjson（C 实作）在大档案内容的编码/解码上比 stdlib json 快好几倍，
+# 有装就用，没装就退回 stdlib
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+def _json_loads(json_str: str) -> Any:
+    if orjson is not None:
+        return orjson.loads(json_str)
+    return json.loads(json_str)
+
+def _json_dumps_sorted(obj: Any) -> str:
+    if orjson is not None:
+        return orjson.dumps(obj, option=orjson.OPT_SORT_KEYS).decode()
+    return json.dumps(obj, sort_keys=True, ensure_ascii=False, separators=(",", ":"))
+
 # 载入环境变量
 load_dotenv()
 
-auth_token = None
-with open("env.json", "r") as f:
-    json_str = json.loads(f.read())
-    auth_token = json_str["ANTHROPIC_AUTH_TOKEN"]
+@functools.lru_cache(maxsize=1)
+def _load_auth() -> str:
+    """
+    取得 API token：优先读环境变数，没有才读 env.json。
 
-# 建立 Claude 客户端
-claude_client = anthropic.Anthropic(
-    api_key = auth_token.strip()
-)
+    延后到第一次呼叫 LLM 时才执行（而不是 import 时），
+    测试收集重复 import 这个模组时就不会重复开档。
+    """
+    token = os.environ.get("ANTHROPIC_AUTH_TOKEN")
+    if token:
+        return token.strip()
+    with open("env.json", "r") as f:
+        return json.load(f)["ANTHROPIC_AUTH_TOKEN"].strip()
+
+@functools.lru_cache(maxsize=1)
+def get_claude_client() -> anthropic.Anthropic:
+    """
+    建立（并重用）Claude 客户端。
+
+    自备 httpx client：调大 keep-alive，让整个 session 重用同一条
+    暖连线，省掉每回合 50~150ms 的 TLS/TCP 握手。
+    （不开 http2=True：那需要额外安装 h2 套件，而握手的节省
+    靠 HTTP/1.1 keep-alive 就已经拿到了）
+    """
+    http_client = httpx.Client(
+        limits=httpx.Limits(max_keepalive_connections=4, keepalive_expiry=300),
+        timeout=60
+    )
+    return anthropic.Anthropic(
+        api_key=_load_auth(),
+        http_client=http_client
+    )
 
 # 终端颜色设定
 YOU_COLOR = "\u001b[94m"        # 使用者输入: 蓝色
@@ -26,12 +73,18 @@ ASSISTANT_COLOR = "\u001b[93m"  # AI 回应: 黄色
 RESET_COLOR = "\u001b[0m"       # 重置颜色（原本的颜色）
 
 # 系统提示
+# 只放一行一个的工具目录（名称 + 简述），完整的签名/说明
+# 由模型在第一次使用前透过 describe_tool 查询 —— 系统提示因此
+# 又小又稳定，也更容易吃到 prompt cache
 SYSTEM_PROMPT = """
 你是一个程式码助理，目标是协助我们完成程式设计相关的任务。
-你可以使用一系列可执行的工具，以下是你可以使用的工具：
+你可以使用一系列可执行的工具，以下是工具目录（名称: 简述）：
 
 {tool_list_repr}
 
+第一次使用某个工具之前，请先呼叫 describe_tool 取得它的完整签名与说明，例如：
+tool: describe_tool({{"name": "edit_file"}})
+
 当你想要使用某个工具时，请只回复一行，格式必须完全如下：
 tool: TOOL_NAME({{JSON_ARGS}})，不要包含任何其他内容。
 请使用精简的单行 JSON，并且使用双引号。
@@ -41,9 +94,17 @@ tool: TOOL_NAME({{JSON_ARGS}})，不要包含任何其他内容。
 
 # ================ 工具相关设定 ===================
 
+# 工具只能碰这个根目录底下的路径：
+# 除了挡掉 .. 跳脱，也让 resolve_abs_path 的 cache key 来自有限的集合
+ROOT = Path(os.environ.get("AGENT_ROOT", Path.cwd())).resolve()
+
+@functools.lru_cache(maxsize=1024)
 def resolve_abs_path(path_str: str) -> Path:
     """
-    将相对路径转成绝对路径。
+    将相对路径转成绝对路径（限制在 ROOT 底下）。
+
+    Path.resolve() 会逐层 stat()，而同一个 session 里相同路径会一直出现，
+    所以结果用 lru_cache 记起来（session 中不会搬移档案，cache 是安全的）。
 
     范例:
     file.py
@@ -51,23 +112,59 @@ def resolve_abs_path(path_str: str) -> Path:
     """
     path = Path(path_str).expanduser()
     if not path.is_absolute():
-        path = (Path.cwd() / path).resolve()
+        # 相对路径以 ROOT 为基准（而不是 cwd），
+        # AGENT_ROOT 指到别处时相对路径才会落在 sandbox 里
+        path = (ROOT / path).resolve()
+    else:
+        path = path.resolve()
+    if path != ROOT and ROOT not in path.parents:
+        raise ValueError(f"path escapes AGENT_ROOT: {path}")
     return path
 
+# 单次读档上限：太大的档案会撑爆记忆体，塞进对话也只是浪费 token
+MAX_READ_BYTES = 256 * 1024
+
+# 超过这个大小就改走 mmap，避免 read() 先复制出一份完整的 bytes
+MMAP_THRESHOLD = 1 << 20
+
 def read_file_tool(filename: str) -> Dict[str, Any]:
     """
-    请取使用者指定的档案完整内容。
+    请取使用者指定的档案内容（超过 MAX_READ_BYTES 会截断）。
 
     :param filename: 要读取的档案名称或路径
-    :return: 包含档案路径与内容的 dict
+    :return: 包含档案路径与内容的 dict；被截断时会多带 truncated 与 size
     """
     full_path = resolve_abs_path(filename)
     print(full_path)    # 印出实际读取的档案路径
-    with open(str(full_path), "r") as f:
-        content = f.read()
+    size = full_path.stat().st_size
+
+    # 大档案用 mmap：只把需要的前 MAX_READ_BYTES 解码出来，
+    # 不会先 read() 出一份完整内容的中间复本
+    if size > MMAP_THRESHOLD:
+        with open(str(full_path), "rb") as f:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                content = mm[:MAX_READ_BYTES].decode("utf-8", "replace")
+        return {
+            "file_path": str(full_path),
+            "content": content,
+            "truncated": True,
+            "size": size
+        }
+
+    with open(str(full_path), "rb", buffering=128 * 1024) as f:
+        # 多读 1 byte 来判断是否超过上限
+        data = f.read(MAX_READ_BYTES + 1)
+    if len(data) > MAX_READ_BYTES:
+        return {
+            "file_path": str(full_path),
+            "content": data[:MAX_READ_BYTES].decode("utf-8", "replace"),
+            "truncated": True,
+            "size": size
+        }
     return {
         "file_path": str(full_path),
-        "content": content
+        # errors='replace'：遇到二进位内容不会直接炸掉
+        "content": data.decode("utf-8", "replace")
     }
 
 def list_files_tool(path: str) -> Dict[str, Any]:
@@ -79,17 +176,37 @@ def list_files_tool(path: str) -> Dict[str, Any]:
     """
     full_path = resolve_abs_path(path)
     all_files = []
-    for item in full_path.iterdir():
-        all_files.append({
-            "filename": item.name,
-            "type": "file" if item.is_file() else "dir"
-        })
+    # os.scandir 的 DirEntry.is_file() 直接用 readdir 回传的 d_type，
+    # 不像 pathlib 每个项目都要再 stat() 一次（只有 symlink 需要跟进去查）
+    with os.scandir(full_path) as it:
+        for entry in it:
+            is_file = entry.is_file()
+            all_files.append({
+                "filename": entry.name,
+                "type": "file" if is_file else "dir"
+            })
     return {
         "path": str(full_path),
         "files": all_files
     }
 
-def edit_file_tool(path: str, old_str: str, new_str: str) -> Dict[str, Any]:
+def _writev_all(fd: int, parts: List[Any]) -> None:
+    """
+    把 parts 里的每一段完整写出。
+
+    os.writev 可能短写（EINTR、iovec 数量/大小上限），而档案已经
+    O_TRUNC 过，短写没补完就等于默默写坏档案，所以要循环写到完为止。
+    """
+    while parts:
+        written = os.writev(fd, parts)
+        # 跳过已完整写出的段；写到一半的段换成剩下的切片
+        while parts and written >= len(parts[0]):
+            written -= len(parts[0])
+            parts.pop(0)
+        if written and parts:
+            parts[0] = memoryview(parts[0])[written:]
+
+def edit_file_tool(path: str, old_str: str, new_str: str, durable: bool = False) -> Dict[str, Any]:
     """
     编辑档案内容：
     - 将档案中 [第一次出现] 的 old_str 换成 new_str
@@ -98,97 +215,324 @@ def edit_file_tool(path: str, old_str: str, new_str: str) -> Dict[str, Any]:
     :param path: 要编辑的档案路径
     :param old_str: 要被取代的字串
     :param new_str: 新的字串内容
+    :param durable: True 时写完会 fsync（预设不做，省掉等磁碟的延迟）
     :return: 回传一个字典，里面会有档案路径（path）和这次做了什么动作（action）。
     """
     full_path = resolve_abs_path(path)
 
     # 如果 old_str 是空的，代表直接写入新档案
     if old_str == "":
-        full_path.write_text(new_str, encoding="utf-8")
+        with open(str(full_path), "wb", buffering=131072) as f:
+            f.write(new_str.encode("utf-8"))
+            if durable:
+                f.flush()
+                os.fsync(f.fileno())
         return {
             "path": str(full_path),
             "action": "created_file"
         }
 
-    original = full_path.read_text(encoding="utf-8")
+    # 直接以 bytes 处理：一次读取、bytes.find 定位，
+    # 不像 read_text + replace + write_text 要把内容复制好几份
+    with open(str(full_path), "rb", buffering=1 << 20) as f:
+        # 提示 kernel 接下来是循序读取，可以更积极地 readahead
+        if hasattr(os, "posix_fadvise"):
+            os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+        data = f.read()
+
+    old_bytes = old_str.encode("utf-8")
+    idx = data.find(old_bytes)
 
     # 找不到取代的字串
-    if original.find(old_str) == -1:
+    if idx == -1:
         return {
             "path": str(full_path),
             "action": "old_str not found"
         }
-    
-    # 只取代第一次出现的位置
-    edited = original.replace(old_str, new_str, 1)
-    full_path.write_text(edited, encoding="utf-8")
+
+    # 只取代第一次出现的位置：
+    # 用 writev 一次写出 [前缀, 新字串, 后缀] 三段，不需要串接出完整新内容
+    view = memoryview(data)
+    fd = os.open(str(full_path), os.O_WRONLY | os.O_CREAT | os.O_TRUNC)
+    try:
+        _writev_all(fd, [
+            view[:idx],
+            new_str.encode("utf-8"),
+            view[idx + len(old_bytes):]
+        ])
+        if durable:
+            os.fsync(fd)
+    finally:
+        os.close(fd)
 
     return {
         "path": str(full_path),
         "action": "edited"
     }
 
+def describe_tool_tool(name: str) -> Dict[str, Any]:
+    """
+    查询某个工具的完整签名与说明（第一次使用该工具前呼叫）。
+
+    :param name: 工具名称
+    :return: 包含工具名称与完整说明的 dict
+    """
+    if name not in TOOL_REGISTRY:
+        return {
+            "name": name,
+            "error": "unknown tool"
+        }
+    return {
+        "name": name,
+        "description": get_tool_str_representation(name)
+    }
+
 # 工具注册表：让模型知道有哪些 tool 可以用
 TOOL_REGISTRY = {
     "read_file": read_file_tool,
     "list_files": list_files_tool,
-    "edit_file": edit_file_tool
+    "edit_file": edit_file_tool,
+    "describe_tool": describe_tool_tool
 }
 
+# 纯读取、互不影响的工具，可以安全地并行执行
+READ_ONLY_TOOLS = {"read_file", "list_files", "describe_tool"}
+
+def run_tool_invocation(name: str, args: Dict[str, Any]) -> Any:
+    """
+    执行单一工具呼叫（把模型给的 args 转成对应工具的参数）。
+
+    模型给出 sandbox 外的路径时（resolve_abs_path 会 raise ValueError），
+    回传错误 dict 让模型修正，而不是让整个互动回圈挂掉。
+    """
+    tool = TOOL_REGISTRY[name]
+    try:
+        if name == "read_file":
+            return tool(args.get("filename", "."))
+        elif name == "list_files":
+            return tool(args.get("path", "."))
+        elif name == "edit_file":
+            return tool(
+                args.get("path", "."),
+                args.get("old_str", ""),
+                args.get("new_str", "")
+            )
+        elif name == "describe_tool":
+            return tool(args.get("name", ""))
+    except ValueError as exc:
+        return {
+            "tool": name,
+            "error": str(exc)
+        }
+    return ""
+
 # 将单一工具转成文字描述（给模型看的）
-def get_tool_str_representation(tool_name: str) -> str:
-    tool = TOOL_REGISTRY[tool_name]
-    return f"""
+# TOOL_REGISTRY 在 import 后不会再变动，所以在 import 时一次算好，
+# 之后每个回合直接查表，不用重跑 inspect.signature
+def _build_tool_doc_cache() -> Dict[str, str]:
+    cache = {}
+    for tool_name, tool in TOOL_REGISTRY.items():
+        cache[tool_name] = f"""
     Name: {tool_name}
     Description: {tool.__doc__}
     Signature: {inspect.signature(tool)}
     """
+    return cache
+
+_TOOL_DOC_CACHE: Dict[str, str] = _build_tool_doc_cache()
+
+def get_tool_str_representation(tool_name: str) -> str:
+    return _TOOL_DOC_CACHE[tool_name]
+
+# 工具呼叫格式：tool: TOOL_NAME({...})，一行一个
+# 编译一次、整段扫描，取代原本逐行 split/strip 的 Python 层解析
+_TOOL_RE = re.compile(r'(?m)^\s*tool:\s*(\w+)\s*\((\{.*?\})\)\s*$', re.DOTALL)
+
+def _safe_json(json_str: str):
+    try:
+        return _json_loads(json_str)
+    except Exception:
+        return None
 
 # 从模型输出的文字中，解析出工具呼叫
 def extract_tool_invocations(text: str) -> List[Tuple[str, Dict[str, Any]]]:
     invocations = []
-    for raw_line in text.splitlines():
-        line = raw_line.strip()
-        if not line.startswith("tool:"):
-            continue
-        try:
-            after = line[len("tool:"):].strip()
-            name, rest = after.split("(", 1)
-            name = name.strip()
-            if not rest.endswith(")"):
-                continue
-            json_str = rest[:-1].strip()
-            args = json.loads(json_str)
-            invocations.append((name, args))
-        except Exception as e:
-            continue
+    for m in _TOOL_RE.finditer(text):
+        args = _safe_json(m.group(2))
+        if args is not None:
+            invocations.append((m.group(1), args))
     return invocations
 
+# ================ 对话历史管理 ================= #
+
+# 滑动视窗大小：只保留最近 MAX_TURNS 轮（user + assistant 共 2*MAX_TURNS 则讯息），
+# 更早的内容压缩成一则摘要，避免每回合都把整段历史重送给模型
+MAX_TURNS = 20
+
+def summarize_messages(messages: List[Dict[str, str]]) -> str:
+    """
+    请模型把被裁掉的旧对话压缩成一小段摘要（200 token 以内）。
+    """
+    transcript = "\n".join(
+        f"{msg['role']}: {msg['content']}" for msg in messages
+    )
+    response = get_claude_client().messages.create(
+        model="claude-3-5-sonnet-20240620",
+        max_tokens=256,
+        messages=[{
+            "role": "user",
+            "content": f"请在 200 个 token 以内摘要以下对话纪录，保留关键事实与未完成的任务：\n\n{transcript}"
+        }]
+    )
+    return response.content[0].text
+
+def trim_history(conversation: deque) -> deque:
+    """
+    对话太长时裁剪历史：
+    - 超过 2*MAX_TURNS 则讯息才触发
+    - 触发时只保留最后 MAX_TURNS 则，更早的部分先摘要，
+      再用一则合成的 user 讯息取代
+
+    裁剪后长度（MAX_TURNS+1）远低于触发门槛，所以摘要是偶尔发生的
+    一次性成本，不会每个回合都多付一次 LLM 呼叫。
+
+    对话本体放在 deque(maxlen=...) 里，就算摘要来不及做，
+    淘汰最旧讯息也是 O(1)，不会像 list 的 del lst[:k] 要整段搬移。
+    """
+    if len(conversation) <= 2 * MAX_TURNS:
+        return conversation
+
+    msgs = list(conversation)
+    old, recent = msgs[:-MAX_TURNS], msgs[-MAX_TURNS:]
+    summary = summarize_messages(old)
+    return deque([{
+        "role": "user",
+        "content": f"[earlier summary] {summary}"
+    }] + recent, maxlen=conversation.maxlen)
+
 # ================ LLM 呼叫相关设定 ================= #
+def _short_desc(tool) -> str:
+    """取 docstring 的第一行当作简述。"""
+    doc = (tool.__doc__ or "").strip()
+    return doc.splitlines()[0] if doc else ""
+
+@functools.lru_cache(maxsize=1)
 def get_full_system_prompt():
     """
     组合完整的 system prompt
-    （原本的 SYSTEM_PROMPT 加上所有工具的说明）
+    （原本的 SYSTEM_PROMPT 加上一行一个的工具目录）
+
+    用 lru_cache 让每次回传的字串完全相同，
+    避免重复组字串，也确保 prompt cache 的 key 稳定。
     """
 
-    tool_str_repr = ""
-    for tool_name in TOOL_REGISTRY:
-        tool_str_repr += "TOOL\n===" + get_tool_str_representation(tool_name)
-        tool_str_repr += f"\n{'='*15}\n"
+    tool_str_repr = "\n".join(
+        f"- {tool_name}: {_short_desc(tool)}"
+        for tool_name, tool in TOOL_REGISTRY.items()
+    )
     return SYSTEM_PROMPT.format(tool_list_repr=tool_str_repr)
 
 def execute_llm_call(conversation: List[Dict[str, str]]):
    """
    调用 Claude API 并返回响应结果
-   """ 
-   response = claude_client.messages.create(
+
+   system prompt 是静态的，挂上 cache_control 让 Anthropic 在 5 分钟内
+   重用 server 端的 prompt cache，后续回合只需付约 10% 的输入 token 费用。
+   另外在最后一则讯息挂上 cache breakpoint，让已经送过的对话前缀
+   也能随回合逐渐被 cache 起来（前缀必须逐字相同，所以不回头改旧讯息）。
+   """
+   messages = list(conversation)
+   if messages:
+        last = messages[-1]
+        messages[-1] = {
+            "role": last["role"],
+            "content": [{
+                "type": "text",
+                "text": last["content"],
+                "cache_control": {"type": "ephemeral"}
+            }]
+        }
+   # 改用 streaming：工具呼叫通常出现在回应的前几十个 token，
+   # 一侦测到完整的 tool: 行就关掉 stream，不用等整段 1024 token 生成完
+   #
+   # 提早中断的条件要很保守：
+   # - 只扫已经收到换行、确定完整的行（行尾没到之前，regex 的 $ 会在
+   #   buffer 结尾误判，像 old_str 里含有 "})" 就会被当成呼叫结束）
+   # - 比对到的 JSON 参数要真的 parse 得过才算数
+   # - 用 scanned 记录扫过的行界，避免每个 chunk 都从头重扫整段文字
+   buf: List[str] = []
+   scanned = 0
+   with get_claude_client().messages.stream(
         model="claude-3-5-sonnet-20240620",
-        messages=conversation,
+        messages=messages,
         max_tokens=1024,
-        system=get_full_system_prompt()
-   )
+        system=[{
+            "type": "text",
+            "text": get_full_system_prompt(),
+            "cache_control": {"type": "ephemeral"}
+        }],
+        extra_headers={"anthropic-beta": "prompt-caching-2024-07-31"}
+   ) as stream:
+        for text in stream.text_stream:
+            buf.append(text)
+            if "\n" not in text:
+                continue
+            partial = "".join(buf)
+            complete = partial[:partial.rfind("\n") + 1]
+            for m in _TOOL_RE.finditer(complete, scanned):
+                if _safe_json(m.group(2)) is not None:
+                    stream.close()
+                    return partial
+            scanned = len(complete)
+        response = stream.get_final_message()
+
+   # 观察 cache 命中状况（第一次呼叫会是 0，之后应该看到非零）
+   cache_read = getattr(response.usage, "cache_read_input_tokens", None)
+   if cache_read is not None:
+        print(f"[cache] cache_read_input_tokens={cache_read}")
+
+   return "".join(buf)
+
+def execute_llm_call_batch(conversations: List[List[Dict[str, str]]]) -> List[str]:
+    """
+    批次版的 LLM 呼叫：一次送出多段对话给 Batch API。
 
-   return response.content[0].text
+    互动情境用不到，但回放/脚本化的 agent session（测试、批次改码）
+    不在乎延迟，走 Batch API 只要一半的价钱；system prompt 沿用同一个
+    cache_control 区块，批次请求一样吃得到 prompt cache。
+    """
+    system_block = [{
+        "type": "text",
+        "text": get_full_system_prompt(),
+        "cache_control": {"type": "ephemeral"}
+    }]
+    batch = get_claude_client().messages.batches.create(
+        requests=[
+            {
+                "custom_id": f"c{i}",
+                "params": {
+                    "model": "claude-3-5-sonnet-20240620",
+                    "max_tokens": 1024,
+                    "system": system_block,
+                    "messages": conv
+                }
+            }
+            for i, conv in enumerate(conversations)
+        ]
+    )
+
+    # 轮询直到整批处理完毕
+    while batch.processing_status != "ended":
+        time.sleep(5)
+        batch = get_claude_client().messages.batches.retrieve(batch.id)
+
+    responses = {}
+    for entry in get_claude_client().messages.batches.results(batch.id):
+        if entry.result.type == "succeeded":
+            responses[entry.custom_id] = entry.result.message.content[0].text
+        else:
+            responses[entry.custom_id] = ""
+    return [responses.get(f"c{i}", "") for i in range(len(conversations))]
 
 # ================== 主程式 =================== #
 def run_coding_agent_loop():
@@ -205,7 +549,12 @@ def run_coding_agent_loop():
     #     "role": "system",
     #     "content": get_full_system_prompt()
     # }]
-    conversation = []
+    # maxlen 只是溢位保险、不是工作长度：取 4*MAX_TURNS，
+    # 远大于 trim_history 的触发门槛（2*MAX_TURNS），正常情况下
+    # 轮不到 deque 淘汰，摘要讯息也不会刚产生就被挤掉；
+    # 只有单一回合塞进异常大量 tool_result 时才会触发 O(1) 淘汰
+    # （system prompt 另外传，不占名额）
+    conversation = deque(maxlen=4 * MAX_TURNS)
 
     while True:
         try:
@@ -219,6 +568,7 @@ def run_coding_agent_loop():
         })    
 
         while True:
+            conversation = trim_history(conversation)
             assistant_response = execute_llm_call(conversation)
             tool_invocations = extract_tool_invocations(assistant_response)
 
@@ -231,27 +581,33 @@ def run_coding_agent_loop():
                 })
                 break
             
-            # 有工具呼叫就逐一执行
+            # 有工具呼叫就执行：同一回合的多个纯读取工具（多半卡在磁碟 I/O）
+            # 用 thread pool 并行跑；只要有 edit_file 就维持依序执行，避免写入竞争
             for name, args in tool_invocations:
-                tool = TOOL_REGISTRY[name]
-                resp = ""
                 print("呼叫工具", name, args, "\n\n")
 
-                if name == "read_file":
-                    resp = tool(args.get("filename", "."))
-                elif name == "list_files":
-                    resp = tool(args.get("path", "."))
-                elif name == "edit_file":
-                    resp = tool(
-                        args.get("path", "."),
-                        args.get("old_str", ""),
-                        args.get("new_str", "")
-                    )
-                
+            if len(tool_invocations) > 1 and all(
+                name in READ_ONLY_TOOLS for name, _ in tool_invocations
+            ):
+                with ThreadPoolExecutor(max_workers=8) as ex:
+                    results = list(ex.map(
+                        lambda inv: run_tool_invocation(inv[0], inv[1]),
+                        tool_invocations
+                    ))
+            else:
+                results = [
+                    run_tool_invocation(name, args)
+                    for name, args in tool_invocations
+                ]
+
+            for resp in results:
                 # 把工具执行结果回传给模型
+                # sort_keys + 固定分隔符号：让同样的结果序列化出逐字相同的字串，
+                # 对话前缀才不会因 key 顺序抖动而让 prompt cache 失效
+                resp_str = _json_dumps_sorted(resp)
                 conversation.append({
                     "role": "user",
-                    "content": f"tool_result{json.dumps(resp)}"
+                    "content": f"tool_result{resp_str}"
                 })
                 print("工具回传结果", resp, "\n\n")
             
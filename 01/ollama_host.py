@@ -1,6 +1,8 @@
 import asyncio
+import functools
 import json
 import sys
+from collections import deque
 from typing import Any, Dict, List, Optional, Tuple
 
 from ollama import chat
@@ -8,27 +10,64 @@ from ollama import chat
 from mcp import ClientSession, StdioServerParameters
 from mcp.client.stdio import stdio_client
 
+# orjson（C 实作）比 stdlib json 快好几倍，有装就用，没装就退回 stdlib
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+def _json_loads(json_str: str) -> Any:
+    if orjson is not None:
+        return orjson.loads(json_str)
+    return json.loads(json_str)
+
+def _json_dumps(obj: Any) -> str:
+    if orjson is not None:
+        return orjson.dumps(obj).decode()
+    return json.dumps(obj, ensure_ascii=False)
+
+# 工具清单在 session 内不会变，整理好的文字以工具名称组合为 key 记起来，
+# 即使之后被重复呼叫也只做一次 getattr/序列化
+# （不能用 id(tools) 当 key：list 被回收后 id 可能被重用，会拿到别人的快取）
+_TOOL_TEXT_CACHE: Dict[Tuple[str, ...], str] = {}
+
+def _tool_names_key(tools: List[Any]) -> Tuple[str, ...]:
+    return tuple(
+        str(getattr(t, "name", None) or t.get("name")) for t in tools
+    )
+
 def format_tools_for_prompt(tools: List[Any]) -> str:
     """
     把 MCP tools/list 回传的工具，整理成适合放进 system prompt 的文字描述。
     """
-    lines: List[str] = []
+    key = _tool_names_key(tools)
+    cached = _TOOL_TEXT_CACHE.get(key)
+    if cached is not None:
+        return cached
+
+    # 每个工具组成一段完整文字，最后一次 join，
+    # 避免逐行 append 的多次小字串操作
+    parts: List[str] = []
     for t in tools:
         name = getattr(t, "name", None) or t.get("name")
         desc = getattr(t, "description", None) or t.get("description") or ""
         input_schema = getattr(t, "inputSchema", None) or t.get("inputSchema") or {}
 
-        lines.append(f"- name: {name}")
-        if desc:
-            lines.append(f" description: {desc}")
-        
         try:
-            schema_str = json.dumps(input_schema, ensure_ascii=False)
+            schema_str = _json_dumps(input_schema)
         except Exception:
             schema_str = str(input_schema)
-        lines.append(f" inputSchema: {schema_str}")
-    return "\n".join(lines)
 
+        if desc:
+            parts.append(f"- name: {name}\n description: {desc}\n inputSchema: {schema_str}")
+        else:
+            parts.append(f"- name: {name}\n inputSchema: {schema_str}")
+
+    text = "\n".join(parts)
+    _TOOL_TEXT_CACHE[key] = text
+    return text
+
+@functools.lru_cache(maxsize=None)
 def build_system_prompt(tool_text: str) -> str:
     """
     因为 Ollama 没有内建 tool calling，我们用 prompt 规范输出格式：
@@ -63,6 +102,51 @@ tool_result: <JSON>
 收到 tool_result 后，请根据结果继续推理；如果还需要更多工具呼叫，请再次输出符合规则的 JSON 物件。
 """
 
+# 滑动视窗大小：system 讯息之外，只保留最近 MAX_TURNS 轮（2*MAX_TURNS 则讯息），
+# 更早的对话压缩成一则摘要，避免 token 成本随著对话长度线性成长
+MAX_TURNS = 20
+
+def summarize_messages(messages: List[Dict[str, str]], model: str) -> str:
+    """
+    请模型把被裁掉的旧对话压缩成一小段摘要（200 token 以内）。
+    """
+    transcript = "\n".join(
+        f"{msg['role']}: {msg['content']}" for msg in messages
+    )
+    resp = chat(
+        model=model,
+        messages=[{
+            "role": "user",
+            "content": f"请在 200 个 token 以内摘要以下对话纪录，保留关键事实与未完成的任务：\n\n{transcript}",
+        }],
+        options={"temperature": 0.2},
+    )
+    return resp["message"]["content"]
+
+def trim_history(turns: deque, model: str) -> deque:
+    """
+    对话太长时裁剪历史（system 讯息另外保存，不在 turns 里）：
+    - 超过 2*MAX_TURNS 则讯息才触发
+    - 触发时只保留最后 MAX_TURNS 则，更早的部分先摘要，
+      再用一则合成的 user 讯息取代
+
+    裁剪后长度（MAX_TURNS+1）远低于触发门槛，所以摘要是偶尔发生的
+    一次性成本，不会每个回合都多付一次 LLM 呼叫。
+
+    turns 放在 deque(maxlen=...) 里，就算摘要来不及做，
+    淘汰最旧讯息也是 O(1)，不会像 list 的 del lst[:k] 要整段搬移。
+    """
+    if len(turns) <= 2 * MAX_TURNS:
+        return turns
+
+    msgs = list(turns)
+    old, recent = msgs[:-MAX_TURNS], msgs[-MAX_TURNS:]
+    summary = summarize_messages(old, model)
+    return deque([{
+        "role": "user",
+        "content": f"[earlier summary] {summary}",
+    }] + recent, maxlen=turns.maxlen)
+
 def try_parse_tool_call(text: str) -> Optional[Dict[str, Any]]:
     """
     侦测模型是否输出 [纯 JSON] 的 tool call。
@@ -73,7 +157,7 @@ def try_parse_tool_call(text: str) -> Optional[Dict[str, Any]]:
     if not (text.startswith("{") and text.endswith("}")):
         return None
     try:
-        obj = json.loads(text)
+        obj = _json_loads(text)
     except Exception:
         return None
     
@@ -108,7 +192,24 @@ async def main() -> None:
             system_prompt = build_system_prompt(tool_text)
 
             # 3) 进入互动式聊天
-            messages: List[Dict[str, str]] = [{"role": "system", "content": system_prompt}]
+            # system 讯息独立保存，maxlen 只套用在对话回合上
+            #
+            # KV-cache 不变式：ollama/llama.cpp 会重用「与上一次请求逐字相同的
+            # 最长前缀」的 KV cache，所以 turns 里已经送出的讯息绝对不回头修改，
+            # 只能 append；trim_history 也只会把最旧的一段换成新的摘要开头
+            # （等于换一个新的 cache root），不会改写中间的讯息
+            system_message: Dict[str, str] = {"role": "system", "content": system_prompt}
+            # maxlen 只是溢位保险、不是工作长度：取 4*MAX_TURNS，
+            # 远大于 trim_history 的触发门槛（2*MAX_TURNS），正常情况下
+            # 轮不到 deque 淘汰，摘要讯息也不会刚产生就被挤掉
+            turns: deque = deque(maxlen=4 * MAX_TURNS)
+
+            # num_keep：粗估 system prompt 的 token 数（约 4 字元/token），
+            # 让 ollama 在 context shift 时固定住 system 开头的 KV cache
+            chat_options = {
+                "num_keep": len(system_prompt) // 4,
+                "temperature": 0.2,
+            }
             print(f"🤖 　系统讯息：\n{system_prompt}\n")
             print("✅ 已连上 MCP server（stdio）。输入你的问题开始测试。")
             print("💡 提示：你可以试试：'列出当前资料夹档案' 或 '把 README.md 里的人名换成 John'。\n")
@@ -121,21 +222,25 @@ async def main() -> None:
                 if user_input.lower() in {"exit", "quit"}:
                     break
                 
-                messages.append({"role": "user", "content": user_input})
+                turns.append({"role": "user", "content": user_input})
 
                 while True:
-                    # 4) 呼叫 Ollama
-                    resp = chat(
+                    # 4) 呼叫 Ollama（太长的历史先裁剪）
+                    # chat() 是同步的 HTTP 呼叫，会卡住整个 event loop，
+                    # 丢进 worker thread 让 loop 在模型生成期间还能处理 MCP I/O
+                    turns = await asyncio.to_thread(trim_history, turns, "qwen3:4b")
+                    resp = await asyncio.to_thread(
+                        chat,
                         model="qwen3:4b",
-                        messages=messages,
-                        options={"temperature": 0.2}
+                        messages=[system_message] + list(turns),
+                        options=chat_options,
                     )
                     assistant_text = resp["message"]["content"]
                     tool_call = try_parse_tool_call(assistant_text)
 
                     if not tool_call:
                         # 没有使用工具就正常回答
-                        messages.append({"role": "assistant", "content": assistant_text})
+                        turns.append({"role": "assistant", "content": assistant_text})
                         print(f"\nAI：{assistant_text}\n")
                         break
                     
@@ -156,11 +261,12 @@ async def main() -> None:
                         result_json = {"error": str(e), "tool": tool_name, "args": tool_args}
                     
                     # 6) 把 tool_result 丟回模型，让它接着推理/回答/或再呼叫下一个工具
-                    messages.append({"role": "assistant", "content": assistant_text})
-                    messages.append(
+                    #    （只 append、不改旧讯息，维持 KV-cache 前缀不变式）
+                    turns.append({"role": "assistant", "content": assistant_text})
+                    turns.append(
                         {
                             "role": "user",
-                            "content": "tool_result: " + json.dumps(result_json, ensure_ascii=False),
+                            "content": "tool_result: " + _json_dumps(result_json),
                         }
                     )
                     print(f"🛠 工具执行结果：{result_json}\n")
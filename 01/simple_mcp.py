@@ -1,58 +1,114 @@
+import functools
+import mmap
+import os
+import stat
+
 from pathlib import Path
 from typing import Any, Dict, List
 from fastmcp import FastMCP
 
 mcp = FastMCP(name="SimpleMCPTestServer")
 
+# 单次读档上限：太大的档案会撑爆记忆体，塞进对话也只是浪费 token
+MAX_READ_BYTES = 256 * 1024
+
+# 超过这个大小就改走 mmap，避免 read() 先复制出一份完整的 bytes
+MMAP_THRESHOLD = 1 << 20
+
+# 工具只能碰这个根目录底下的路径：
+# 除了挡掉 .. 跳脱，也让 resolve_abs_path 的 cache key 来自有限的集合
+ROOT = Path(os.environ.get("AGENT_ROOT", Path.cwd())).resolve()
+
 # helper: 把使用者输入的路径转成绝对路径
+@functools.lru_cache(maxsize=1024)
 def resolve_abs_path(path_str : str) -> Path:
     """
-    [功能] 把使用者输入的路径转成绝对路径
+    [功能] 把使用者输入的路径转成绝对路径（限制在 ROOT 底下）
+
+    Path.resolve() 会逐层 stat()，而同一个 session 里相同路径会一直出现，
+    所以结果用 lru_cache 记起来（session 中不会搬移档案，cache 是安全的）
 
     范例：
-      file.py -> /Users/home/mihail/modern-software-dev-lectures/file.py  
+      file.py -> /Users/home/mihail/modern-software-dev-lectures/file.py
     """
     path = Path(path_str).expanduser()
     if not path.is_absolute():
-        path = (Path.cwd() / path).resolve()
+        # 相对路径以 ROOT 为基准（而不是 cwd），
+        # AGENT_ROOT 指到别处时相对路径才会落在 sandbox 里
+        path = (ROOT / path).resolve()
+    else:
+        path = path.resolve()
+    if path != ROOT and ROOT not in path.parents:
+        raise ValueError(f"path escapes AGENT_ROOT: {path}")
     return path
 
 @mcp.tool
 def read_file_tool(filename: str) -> Dict[str, Any]:
     """
-    [功能] 读取使用者指定档案的完整内容
+    [功能] 读取使用者指定档案的内容（超过 MAX_READ_BYTES 会截断）
 
     参数:
       filename: 要读取的档案路径（可相对或绝对）
-    
+
     回传：
       - file_path: 档案的绝对路径（字串）
-      - content: 档案内容（字串）
+      - content: 档案内容（字串，用 errors='replace' 解码，遇到二进位不会炸）
+      - truncated / size: 内容被截断时才会出现
     """
     full_path = resolve_abs_path(filename)
     print(full_path)
-    if not full_path.exists():
+    # 一次 os.stat 同时回答「存在吗 / 是一般档案吗 / 多大」，
+    # 取代 exists() + is_file() + stat() 三次 syscall
+    # （except OSError：除了档案不存在，路径成分是一般档案时会是
+    # NotADirectoryError、没权限时是 PermissionError，都照 exists() 的
+    # 行为当成「找不到」回报，不让例外往外漏）
+    try:
+        st = os.stat(full_path)
+    except OSError:
         return {
             "file_path": str(full_path),
             "error": "file not found"
         }
-    if not full_path.is_file():
+    if not stat.S_ISREG(st.st_mode):
         return {
             "file_path": str(full_path),
             "error": "path is not a file"
         }
-    
+
     try:
-        with open(str(full_path), "r", encoding="utf-8") as f:
-            content = f.read()
-    except (OSError, UnicodeDecodeError) as exc:
+        size = st.st_size
+
+        # 大档案用 mmap：只把需要的前 MAX_READ_BYTES 解码出来，
+        # 不会先 read() 出一份完整内容的中间复本
+        if size > MMAP_THRESHOLD:
+            with open(str(full_path), "rb") as f:
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                    content = mm[:MAX_READ_BYTES].decode("utf-8", "replace")
+            return {
+                "file_path": str(full_path),
+                "content": content,
+                "truncated": True,
+                "size": size
+            }
+
+        with open(str(full_path), "rb", buffering=128 * 1024) as f:
+            # 多读 1 byte 来判断是否超过上限
+            data = f.read(MAX_READ_BYTES + 1)
+    except OSError as exc:
         return {
             "file_path": str(full_path),
             "error": str(exc)
         }
+    if len(data) > MAX_READ_BYTES:
+        return {
+            "file_path": str(full_path),
+            "content": data[:MAX_READ_BYTES].decode("utf-8", "replace"),
+            "truncated": True,
+            "size": size
+        }
     return {
         "file_path": str(full_path),
-        "content": content
+        "content": data.decode("utf-8", "replace")
     }
 
 @mcp.tool
@@ -70,20 +126,38 @@ def list_files_tool(path: str) -> Dict[str, Any]:
           - type: "file" 或 "dir"
     """
     full_path = resolve_abs_path(path)
+    # 一次 os.stat 同时回答「存在吗 / 是资料夹吗」
+    # （except OSError：理由同 read_file_tool，见上）
+    try:
+        st = os.stat(full_path)
+    except OSError:
+        return {
+            "path": str(full_path),
+            "error": "directory not found"
+        }
+    if not stat.S_ISDIR(st.st_mode):
+        return {
+            "path": str(full_path),
+            "error": "path is not a directory"
+        }
+
     all_files = []
-    for item in full_path.iterdir():
-        isFile = item.is_file()
-        all_files.append({
-            "filename": ("💙" if isFile else "📂") + item.name,
-            "type": "file" if isFile else "dir"
-        })
+    # os.scandir 的 DirEntry.is_file() 直接用 readdir 回传的 d_type，
+    # 不像 pathlib 每个项目都要再 stat() 一次（只有 symlink 需要跟进去查）
+    with os.scandir(full_path) as it:
+        for entry in it:
+            isFile = entry.is_file()
+            all_files.append({
+                "filename": ("💙" if isFile else "📂") + entry.name,
+                "type": "file" if isFile else "dir"
+            })
     return {
         "path": str(full_path),
         "files": all_files
     }
 
 @mcp.tool
-def edit_file_tool(path: str, old_str: str, new_str: str) -> Dict[str, Any]:
+def edit_file_tool(path: str, old_str: str, new_str: str, durable: bool = False) -> Dict[str, Any]:
     """
     [功能] 编辑档案内容
     - 用 new_str 取代第一次出现的 old_str
@@ -93,23 +167,32 @@ def edit_file_tool(path: str, old_str: str, new_str: str) -> Dict[str, Any]:
       path: 要编辑的档案路径
       old_str: 要被替换的旧字串
       new_str: 替换成的新字串
-    
+      durable: True 时写完会 fsync（预设不做，省掉等磁碟的延迟）
+
     回传:
       - path: 档案绝对路径（字串）
       - action: 执行结果（created_file / edited / old_str not found)
     """
     full_path = resolve_abs_path(path)
-    p = Path(full_path)
 
     # old_str 是空字串：直接建立或覆写整个档案内容
     if old_str == "":
-        p.write_text(new_str, encoding="utf-8")
+        with open(str(full_path), "wb", buffering=131072) as f:
+            f.write(new_str.encode("utf-8"))
+            if durable:
+                f.flush()
+                os.fsync(f.fileno())
         return {
             "path": str(full_path),
             "action": "created_file"
         }
 
-    original = p.read_text(encoding="utf-8")
+    # 128 KiB buffer：比预设 8 KiB 少非常多 read 的 syscall
+    with open(str(full_path), "rb", buffering=131072) as f:
+        # 提示 kernel 接下来是循序读取，可以更积极地 readahead
+        if hasattr(os, "posix_fadvise"):
+            os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+        original = f.read().decode("utf-8")
 
     # 找不到 old_str 就回报
     if original.find(old_str) == -1:
@@ -120,7 +203,11 @@ def edit_file_tool(path: str, old_str: str, new_str: str) -> Dict[str, Any]:
 
     # 只替换第一次出现的 old_str
     edited = original.replace(old_str, new_str, 1)
-    p.write_text(edited, encoding="utf-8")
+    with open(str(full_path), "wb", buffering=131072) as f:
+        f.write(edited.encode("utf-8"))
+        if durable:
+            f.flush()
+            os.fsync(f.fileno())
     return {
         "path": str(full_path),
         "action": "edited"